@@ -1,12 +1,19 @@
+import asyncio
+import concurrent.futures
+import fcntl
 import os
-import subprocess
-import uuid
+import queue
+import shutil
+import time
 import logging
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
+from urllib.parse import quote
 
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,12 +28,600 @@ app = FastAPI(title="Audio Converter Service")
 OUTPUT_DIR = Path("/app/output")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-TEMP_DIR = Path("/tmp/audio_converter")
+# В docker-compose эта директория смонтирована как tmpfs: временные файлы живут в RAM
+TEMP_DIR = Path(os.getenv("TEMP_DIR", "/tmp/audio_converter"))
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
 SUPPORTED_FORMATS = ["mp3", "ogg", "aac", "m4a", "wav", "mp4"]
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB максимум
 
+# MIME типы форматов (для mp3 корректный тип — audio/mpeg, а не audio/mp3)
+MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+    "aac": "audio/aac",
+    "m4a": "audio/mp4",
+    "wav": "audio/wav",
+    "mp4": "audio/mp4",
+}
+DEFAULT_MEDIA_TYPE = "application/octet-stream"
+# Запас на границы multipart и поля формы при проверке Content-Length запроса
+MULTIPART_OVERHEAD = 64 * 1024
+CHUNK_SIZE = 1024 * 1024  # 1MB чанки
+FFMPEG_TIMEOUT = 300  # таймаут 5 минут для больших файлов
+
+# Полные пути к ffmpeg/ffprobe ищем один раз, чтобы не обходить $PATH при каждом запуске
+FFMPEG_BIN = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE_BIN = shutil.which("ffprobe") or "ffprobe"
+
+# Ограничение потоков одного ffmpeg и числа одновременных конвертаций:
+# несколько ffmpeg по FFMPEG_THREADS потоков загружают ядра лучше, чем один на все ядра
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "4"))
+MAX_CONCURRENT_CONVERSIONS = int(os.getenv(
+    "MAX_CONCURRENT_CONVERSIONS",
+    str(max(1, (os.cpu_count() or 1) // FFMPEG_THREADS))
+))
+CONVERT_SEM = asyncio.Semaphore(MAX_CONCURRENT_CONVERSIONS)
+
+# Ogg/Opus кодируется в разы быстрее Ogg/Vorbis, но поддерживается не всеми
+# клиентами, поэтому включается явно
+OGG_USE_OPUS = os.getenv("OGG_USE_OPUS", "false").lower() in ("1", "true", "yes")
+
+# Явные параметры энкодеров вместо значений ffmpeg по умолчанию
+ENCODER_ARGS = {
+    "mp3": ["-c:a", "libmp3lame", "-q:a", "4"],
+}
+if OGG_USE_OPUS:
+    ENCODER_ARGS["ogg"] = ["-c:a", "libopus", "-b:a", "96k", "-vbr", "on"]
+
+# Размер pipe между сервисом и stdin ffmpeg (по умолчанию в Linux 64 KB).
+# 1 MB — потолок /proc/sys/fs/pipe-max-size для непривилегированного процесса
+PIPE_SIZE = 1024 * 1024
+
+# Кодеки, которые целевой контейнер принимает как есть: если входной файл уже
+# в таком кодеке, ffmpeg только перепаковывает поток (-c copy) без перекодирования
+COPY_CODECS = {
+    "mp3": {"mp3"},
+    "ogg": {"vorbis", "opus", "flac"},
+    "aac": {"aac"},
+    "m4a": {"aac", "alac"},
+    "wav": {"pcm_u8", "pcm_s16le", "pcm_s24le", "pcm_s32le", "pcm_f32le"},
+}
+FFPROBE_TIMEOUT = 10  # секунд
+
+# Результат проверки ffmpeg для /health кэшируется, чтобы не запускать
+# процесс на каждый запрос мониторинга
+FFMPEG_CHECK_TTL = 60  # секунд
+_FFMPEG_CACHE = {"ts": 0.0, "val": None}
+
+# Ограничение размера OUTPUT_DIR: фоновая задача раз в OUTPUT_REAPER_INTERVAL
+# секунд удаляет самые старые файлы, пока суммарный размер превышает лимит
+OUTPUT_DIR_MAX_SIZE = int(float(os.getenv("OUTPUT_DIR_MAX_SIZE_GB", "5")) * 1024 * 1024 * 1024)
+OUTPUT_REAPER_INTERVAL = 60  # секунд
+
+# Размер отдельного пула потоков для блокирующих операций с файлами, чтобы
+# они не останавливали event loop и не конкурировали с пулом потоков Starlette.
+# Сам пул создаётся при старте приложения (app.state.blocking_pool)
+BLOCKING_POOL_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Пул переиспользуемых буферов для чтения загрузок (не больше 32 по CHUNK_SIZE)
+BUFFER_POOL_SIZE = 32
+BUFFER_POOL: "queue.LifoQueue[bytearray]" = queue.LifoQueue(maxsize=BUFFER_POOL_SIZE)
+
+# Контейнеры, которые ffmpeg не может читать из pipe (нужен seek к moov atom),
+# поэтому такие файлы по-прежнему сохраняются во временную директорию.
+# Основной признак — атом ftyp в начале файла, расширения — запасной вариант
+SEEKABLE_INPUT_SUFFIXES = {".mp4", ".m4a", ".mov", ".3gp"}
+
+# Внутренний location nginx, указывающий на OUTPUT_DIR (например, "/protected-output/").
+# Если задан, файлы отдаёт сам nginx через X-Accel-Redirect (sendfile, zero-copy),
+# а Python-процесс не читает их содержимое
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "")
+
+
+class LargeChunkFileResponse(FileResponse):
+    """FileResponse, читающий файл блоками по CHUNK_SIZE вместо 64 KB: в 16 раз меньше read()"""
+    chunk_size = CHUNK_SIZE
+
+
+def ffmpeg_error_message(stderr: str) -> str:
+    """
+    Формирует понятное пользователю сообщение об ошибке ffmpeg
+    
+    Args:
+        stderr: Вывод ffmpeg в stderr
+    
+    Returns:
+        Текст ошибки для ответа клиенту
+    """
+    # Очищаем stderr от лишней информации для пользователя
+    error_msg = stderr.strip()
+    
+    # Определяем тип ошибки для более понятного сообщения
+    if "moov atom not found" in error_msg or "Invalid data" in error_msg:
+        return "The uploaded file is corrupted or not a valid audio file. Please check the file and try again."
+    if "No such file or directory" in error_msg:
+        return "Input file not found. Please try uploading again."
+    
+    # Берём только последние строки с реальной ошибкой
+    error_lines = [line for line in error_msg.split('\n') if line.strip()]
+    return '\n'.join(error_lines[-5:]) if error_lines else error_msg
+
+
+def file_too_large() -> HTTPException:
+    """Ошибка превышения MAX_FILE_SIZE"""
+    return HTTPException(
+        status_code=413,
+        detail=f"File too large. Maximum size: {MAX_FILE_SIZE / (1024*1024):.0f}MB"
+    )
+
+
+async def run_blocking(func, *args):
+    """Выполняет блокирующую функцию в пуле потоков приложения"""
+    return await asyncio.get_running_loop().run_in_executor(app.state.blocking_pool, func, *args)
+
+
+def remove_files(*paths: Path) -> None:
+    """Удаляет файлы, если они существуют"""
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def upload_size(file: UploadFile) -> int:
+    """
+    Размер загруженного файла
+    
+    К вызову эндпоинта Starlette уже принял файл целиком и знает его размер,
+    поэтому лимит проверяется один раз, а не на каждом чанке.
+    """
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(position)
+    return size
+
+
+class UploadSizeLimitMiddleware:
+    """Отклоняет /convert с Content-Length больше лимита до чтения тела запроса"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/convert":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+                error = file_too_large()
+                response = JSONResponse(status_code=error.status_code, content={"detail": error.detail})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+
+@contextmanager
+def pooled_buffer():
+    """
+    Берёт буфер размером CHUNK_SIZE из BUFFER_POOL и возвращает его обратно
+    
+    Если пул пуст, создаётся новый буфер; лишние буферы сверх
+    BUFFER_POOL_SIZE не сохраняются и освобождаются сборщиком мусора.
+    
+    При исключении (в том числе отмене задачи) буфер в пул не возвращается:
+    отмена не останавливает поток, который ещё может читать или писать в него,
+    и данные одной загрузки попали бы в чужой запрос.
+    """
+    try:
+        buf = BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buf = bytearray(CHUNK_SIZE)
+    
+    yield buf
+    
+    try:
+        BUFFER_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+
+async def read_into(file: UploadFile, buf: bytearray) -> int:
+    """
+    Читает следующий чанк загрузки в готовый буфер без создания нового bytes
+    
+    Args:
+        file: Загружаемый файл
+        buf: Буфер для чтения
+    
+    Returns:
+        Количество прочитанных байт (0 в конце файла)
+    """
+    # Как и UploadFile.read(): файл в памяти читаем напрямую, с диска — в потоке
+    if getattr(file.file, "_rolled", True):
+        return await run_blocking(file.file.readinto, buf)
+    return file.file.readinto(buf)
+
+
+def write_all(raw_file, data: memoryview) -> None:
+    """Записывает данные в небуферизованный файл целиком, дописывая остаток при частичной записи"""
+    while data:
+        written = raw_file.write(data)
+        data = data[written:]
+
+
+async def save_upload(file: UploadFile, path: Path) -> None:
+    """
+    Сохраняет загруженный файл на диск чанками
+    
+    Запись чанка выполняется в пуле потоков приложения и идёт параллельно с чтением
+    следующего, поэтому event loop не блокируется на write(). fsync не нужен:
+    файл удаляется сразу после конвертации.
+    
+    Args:
+        file: Загружаемый файл
+        path: Путь для сохранения
+    """
+    pending_write = None
+    
+    # Два буфера: в один читаем следующий чанк, пока второй пишется на диск.
+    # Файл открыт без буферизации Python: каждый чанк — это один write() по
+    # CHUNK_SIZE байт без лишнего копирования через BufferedWriter
+    with open(path, "wb", buffering=0) as buffer, pooled_buffer() as front, pooled_buffer() as back:
+        try:
+            while True:
+                chunk_len = await read_into(file, front)
+                
+                # Дожидаемся записи предыдущего чанка перед следующей
+                if pending_write is not None:
+                    await asyncio.wrap_future(pending_write)
+                    pending_write = None
+                
+                if not chunk_len:
+                    break
+                
+                pending_write = app.state.blocking_pool.submit(write_all, buffer, memoryview(front)[:chunk_len])
+                front, back = back, front
+        finally:
+            # Файл нельзя закрывать, пока поток ещё пишет: отмена задачи поток
+            # не останавливает, поэтому ждём сам concurrent.futures.Future
+            if pending_write is not None and not pending_write.done():
+                await asyncio.shield(asyncio.to_thread(concurrent.futures.wait, [pending_write]))
+
+
+def enlarge_pipe(stream: asyncio.StreamWriter) -> None:
+    """Увеличивает буфер pipe до PIPE_SIZE, чтобы чанк уходил в ffmpeg за меньшее число write()"""
+    set_pipe_size = getattr(fcntl, "F_SETPIPE_SZ", None)  # только Linux
+    if set_pipe_size is None:
+        return
+    try:
+        fcntl.fcntl(stream.get_extra_info("pipe").fileno(), set_pipe_size, PIPE_SIZE)
+    except OSError as e:
+        logger.debug(f"Could not enlarge ffmpeg stdin pipe: {str(e)}")
+
+
+async def feed_ffmpeg(process: asyncio.subprocess.Process, file: UploadFile) -> None:
+    """
+    Передаёт загруженный файл в stdin ffmpeg чанками, без временного файла
+    
+    Args:
+        process: Запущенный процесс ffmpeg с `-i pipe:0`
+        file: Загружаемый файл
+    """
+    enlarge_pipe(process.stdin)
+    
+    try:
+        with pooled_buffer() as buf:
+            while chunk_len := await read_into(file, buf):
+                # write() копирует неотправленный остаток, поэтому буфер можно сразу переиспользовать
+                process.stdin.write(memoryview(buf)[:chunk_len])
+                await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg завершился раньше времени — причину покажет его stderr
+        logger.warning("ffmpeg closed stdin before the upload was fully streamed")
+    finally:
+        process.stdin.close()
+
+
+def needs_seekable_input(head: bytes, suffix: str) -> bool:
+    """
+    Проверяет, нужен ли ffmpeg произвольный доступ к входному файлу
+    
+    Args:
+        head: Первые байты файла
+        suffix: Расширение имени файла от клиента
+    
+    Returns:
+        True для контейнеров семейства MP4 (читать их из pipe нельзя)
+    """
+    # ISO BMFF (mp4, m4a, m4b, mov, 3gp...) начинается с атома ftyp,
+    # независимо от того, какое имя файла прислал клиент
+    if head[4:8] == b"ftyp":
+        return True
+    return suffix.lower() in SEEKABLE_INPUT_SUFFIXES
+
+
+async def read_audio_head(file: UploadFile, head: bytes) -> bytes:
+    """
+    Первые байты аудиоданных загрузки с учётом ID3v2 тега
+    
+    ID3v2 встречается не только перед mp3, но и перед ADTS AAC и FLAC,
+    поэтому формат определяется по первому кадру после тега.
+    
+    Args:
+        file: Загружаемый файл
+        head: Первые 16 байт файла
+    
+    Returns:
+        Первые байты после ID3v2 тега (или head, если тега нет)
+    """
+    if not head.startswith(b"ID3") or len(head) < 10:
+        return head
+    
+    # Размер тега хранится в байтах 6-9 как synchsafe integer (по 7 бит на байт)
+    tag_size = 10 + ((head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F))
+    if head[5] & 0x10:  # есть footer
+        tag_size += 10
+    
+    await file.seek(tag_size)
+    audio_head = await file.read(16)
+    await file.seek(0)
+    return audio_head
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """
+    Определяет формат по первым байтам файла (magic numbers)
+    
+    Args:
+        head: Первые байты файла (достаточно 12)
+    
+    Returns:
+        Формат из SUPPORTED_FORMATS или None, если не распознан
+    """
+    if head.startswith(b"OggS"):
+        return "ogg"
+    if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return "wav"
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Кадр MPEG audio: layer 00 — это ADTS (AAC), layer III — mp3
+        if head[1] & 0x06 == 0:
+            return "aac"
+        if head[1] & 0x06 == 0x02:
+            return "mp3"
+    return None
+
+
+async def probe_codec(path: Path) -> Optional[str]:
+    """
+    Определяет кодек первой аудиодорожки файла через ffprobe
+    
+    Args:
+        path: Путь к файлу
+    
+    Returns:
+        Имя кодека (например, "aac") или None, если определить не удалось
+    """
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFPROBE_BIN,
+            "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name",
+            "-of", "default=nw=1:nk=1",
+            str(path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=FFPROBE_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"ffprobe failed for {path}: {str(e)}")
+        return None
+    finally:
+        await stop_process(process)
+    
+    if process.returncode != 0:
+        return None
+    return stdout.decode(errors="replace").strip() or None
+
+
+def reap_output_dir() -> int:
+    """
+    Удаляет самые старые файлы из OUTPUT_DIR, пока их суммарный размер больше OUTPUT_DIR_MAX_SIZE
+    
+    Returns:
+        Количество удалённых файлов
+    """
+    entries = []
+    total_size = 0
+    
+    # os.scandir читает директорию одним проходом, без отдельного Path для каждого файла
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    
+    if total_size <= OUTPUT_DIR_MAX_SIZE:
+        return 0
+    
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total_size <= OUTPUT_DIR_MAX_SIZE:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        removed += 1
+    
+    return removed
+
+
+async def run_output_reaper() -> None:
+    """Периодически очищает OUTPUT_DIR в фоне"""
+    while True:
+        await asyncio.sleep(OUTPUT_REAPER_INTERVAL)
+        try:
+            removed = await run_blocking(reap_output_dir)
+            if removed:
+                logger.info(f"Removed {removed} old files from {OUTPUT_DIR}")
+        except Exception as e:
+            logger.error(f"Output directory cleanup failed: {str(e)}")
+
+
+def drop_page_cache(path: Path) -> None:
+    """
+    Просит ядро выбросить страницы файла из page cache
+    
+    Файл из OUTPUT_DIR обычно скачивают один раз, поэтому после отдачи его
+    страницы только вытесняют из памяти данные конкурентных запросов.
+    """
+    if not hasattr(os, "posix_fadvise"):  # только Linux
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def output_file_response(path: Path, media_type: str, filename: str) -> Response:
+    """
+    Ответ с файлом из OUTPUT_DIR
+    
+    Args:
+        path: Путь к файлу
+        media_type: MIME тип файла
+        filename: Имя файла для Content-Disposition
+    
+    Returns:
+        X-Accel-Redirect ответ для nginx или LargeChunkFileResponse
+    """
+    if not ACCEL_REDIRECT_PREFIX:
+        return LargeChunkFileResponse(
+            path=str(path),
+            media_type=media_type,
+            filename=filename,
+            background=BackgroundTask(run_blocking, drop_page_cache, path)
+        )
+    
+    # nginx сам отправит файл через sendfile(), тело ответа пустое
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        content_disposition = f"attachment; filename*=utf-8''{quoted_filename}"
+    else:
+        content_disposition = f'attachment; filename="{filename}"'
+    
+    return Response(
+        media_type=media_type,
+        headers={
+            "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quoted_filename}",
+            "Content-Disposition": content_disposition
+        }
+    )
+
+
+async def probe_ffmpeg() -> Tuple[bool, str]:
+    """
+    Проверяет доступность ffmpeg и сохраняет результат в _FFMPEG_CACHE
+    
+    Returns:
+        Кортеж (доступен ли ffmpeg, строка версии или описание ошибки)
+    """
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-version",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=5)
+        ffmpeg_available = process.returncode == 0
+        ffmpeg_version = stdout.decode(errors="replace").split('\n')[0] if ffmpeg_available else "Not available"
+    except Exception as e:
+        ffmpeg_available = False
+        ffmpeg_version = f"Error: {str(e)}"
+    finally:
+        await stop_process(process)
+    
+    _FFMPEG_CACHE["ts"] = time.monotonic()
+    _FFMPEG_CACHE["val"] = (ffmpeg_available, ffmpeg_version)
+    return _FFMPEG_CACHE["val"]
+
+
+async def stop_process(process: Optional[asyncio.subprocess.Process]) -> None:
+    """Завершает процесс ffmpeg, если он ещё работает"""
+    if process is None or process.returncode is not None:
+        return
+    process.kill()
+    await process.wait()
+
+
+@app.on_event("startup")
+async def start_blocking_pool():
+    """Создание пула потоков для блокирующих операций с файлами"""
+    app.state.blocking_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=BLOCKING_POOL_WORKERS,
+        thread_name_prefix="io"
+    )
+
+
+@app.on_event("startup")
+async def warm_up_ffmpeg():
+    """
+    Прогрев ffmpeg при старте сервиса
+    
+    Первый запуск подгружает бинарник, его библиотеки и таблицы кодеков в
+    page cache, поэтому первая конвертация не платит за холодный старт.
+    """
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-hide_banner", "-encoders",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await asyncio.wait_for(process.wait(), timeout=5)
+        logger.info("ffmpeg warmed up")
+    except Exception as e:
+        logger.warning(f"ffmpeg warm-up failed: {str(e)}")
+    finally:
+        await stop_process(process)
+    
+    # Заполняем кэш для /health сразу при старте
+    await probe_ffmpeg()
+
+
+@app.on_event("startup")
+async def start_output_reaper():
+    """Запуск фоновой очистки OUTPUT_DIR"""
+    app.state.output_reaper = asyncio.create_task(run_output_reaper())
+
+
+@app.on_event("shutdown")
+async def stop_output_reaper():
+    """Остановка фоновой очистки OUTPUT_DIR"""
+    app.state.output_reaper.cancel()
+
+
+@app.on_event("shutdown")
+async def shutdown_blocking_pool():
+    """Остановка пула потоков после завершения уже запущенных в нём операций"""
+    # shutdown(wait=True) ждёт потоки, поэтому выполняется вне event loop
+    await asyncio.to_thread(app.state.blocking_pool.shutdown)
+
 
 @app.get("/")
 async def root():
@@ -44,6 +639,9 @@ async def convert_audio(
     """
     Конвертация аудиофайла в указанный формат
     
+    Загруженный файл передаётся в ffmpeg напрямую через stdin. Временный файл
+    создаётся только для контейнеров семейства MP4 (см. needs_seekable_input).
+    
     Args:
         request: Request объект для получения base URL
         file: Загружаемый аудиофайл
@@ -61,107 +659,121 @@ async def convert_audio(
             detail=f"Unsupported format: {target_format}. Supported: {', '.join(SUPPORTED_FORMATS)}"
         )
     
+    # Проверяем размер файла до любой обработки
+    file_size = upload_size(file)
+    if file_size > MAX_FILE_SIZE:
+        raise file_too_large()
+    if file_size == 0:
+        logger.error(f"Uploaded file is empty: {file.filename}")
+        raise HTTPException(
+            status_code=400,
+            detail="Uploaded file is empty or corrupted"
+        )
+    
     # Генерируем уникальное имя для файлов
-    unique_id = str(uuid.uuid4())
+    unique_id = os.urandom(12).hex()
     original_filename = Path(file.filename).stem if file.filename else "audio"
+    input_suffix = Path(file.filename).suffix if file.filename else ''
+    
+    # Способ передачи в ffmpeg выбираем по содержимому, а не только по имени файла
+    head = await file.read(16)
+    await file.seek(0)
+    use_pipe = not needs_seekable_input(head, input_suffix)
     
     # Пути для временного и выходного файлов
-    temp_input_path = TEMP_DIR / f"{unique_id}_input{Path(file.filename).suffix if file.filename else ''}"
+    temp_input_path = TEMP_DIR / f"{unique_id}_input{input_suffix}"
     output_filename = f"{original_filename}_{unique_id}.{target_format}"
     output_path = OUTPUT_DIR / output_filename
     
     logger.info(f"Starting conversion: {file.filename} -> {target_format} (ID: {unique_id})")
     
     try:
-        # Сохраняем загруженный файл во временную директорию чанками
-        # Это предотвращает проблемы с большими файлами
-        chunk_size = 1024 * 1024  # 1MB чанки
-        total_size = 0
+        if not use_pipe:
+            # Сохраняем загруженный файл во временную директорию чанками
+            await save_upload(file, temp_input_path)
+            logger.info(f"File saved successfully: {file_size} bytes")
         
-        with open(temp_input_path, "wb") as buffer:
-            while True:
-                chunk = await file.read(chunk_size)
-                if not chunk:
-                    break
-                
-                total_size += len(chunk)
+        process = None
+        stderr_task = None
+        async with CONVERT_SEM:
+            # Если входной файл уже в нужном формате — только перепаковываем без перекодирования
+            if use_pipe:
+                remux = sniff_format(await read_audio_head(file, head)) == target_format
+            elif target_format in COPY_CODECS:
+                # ffprobe — тоже отдельный процесс, поэтому запускается под CONVERT_SEM
+                remux = await probe_codec(temp_input_path) in COPY_CODECS[target_format]
+            else:
+                remux = False
+            
+            if remux:
+                logger.info(f"Input already matches {target_format}, remuxing with -c copy (ID: {unique_id})")
+            
+            # Выполняем конвертацию через ffmpeg
+            command = [
+                FFMPEG_BIN,
+                "-i", "pipe:0" if use_pipe else str(temp_input_path),
+                "-y",  # перезаписать выходной файл если существует
+                "-loglevel", "error",  # показывать только ошибки
+                *(["-c", "copy"] if remux else ENCODER_ARGS.get(target_format, [])),
+                "-threads", str(FFMPEG_THREADS),
+                str(output_path)
+            ]
+            
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdin=asyncio.subprocess.PIPE if use_pipe else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                # Читаем stderr параллельно, чтобы ffmpeg не заблокировался на полном pipe
+                stderr_task = asyncio.create_task(process.stderr.read())
                 
-                # Проверяем размер файла во время загрузки
-                if total_size > MAX_FILE_SIZE:
-                    temp_input_path.unlink(missing_ok=True)
-                    raise HTTPException(
-                        status_code=413,
-                        detail=f"File too large. Maximum size: {MAX_FILE_SIZE / (1024*1024):.0f}MB"
-                    )
+                # Таймаут покрывает и передачу файла в stdin, и само кодирование:
+                # если ffmpeg перестанет читать stdin, drain() не зависнет навсегда
+                steps = [process.wait()]
+                if use_pipe:
+                    steps.append(feed_ffmpeg(process, file))
+                await asyncio.wait_for(asyncio.gather(*steps), timeout=FFMPEG_TIMEOUT)
                 
-                buffer.write(chunk)
-        
-        # Проверяем, что файл действительно сохранён
-        if not temp_input_path.exists() or temp_input_path.stat().st_size == 0:
-            logger.error(f"Uploaded file is empty: {temp_input_path}")
-            raise HTTPException(
-                status_code=400,
-                detail="Uploaded file is empty or corrupted"
-            )
-        
-        file_size = temp_input_path.stat().st_size
-        logger.info(f"File saved successfully: {file_size} bytes")
-        
-        # Выполняем конвертацию через ffmpeg
-        command = [
-            "ffmpeg",
-            "-i", str(temp_input_path),
-            "-y",  # перезаписать выходной файл если существует
-            "-loglevel", "error",  # показывать только ошибки
-            str(output_path)
-        ]
-        
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            timeout=300  # таймаут 5 минут для больших файлов
-        )
+                if use_pipe:
+                    logger.info(f"File streamed to ffmpeg: {file_size} bytes")
+                stderr = (await stderr_task).decode(errors="replace")
+            finally:
+                await stop_process(process)
+                if stderr_task is not None and not stderr_task.done():
+                    stderr_task.cancel()
         
         # Проверяем результат выполнения
-        if result.returncode != 0:
-            # Очищаем stderr от лишней информации для пользователя
-            error_msg = result.stderr.strip()
-            
-            # Определяем тип ошибки для более понятного сообщения
-            if "moov atom not found" in error_msg or "Invalid data" in error_msg:
-                user_error = "The uploaded file is corrupted or not a valid audio file. Please check the file and try again."
-            elif "No such file or directory" in error_msg:
-                user_error = "Input file not found. Please try uploading again."
-            else:
-                # Берём только последние строки с реальной ошибкой
-                error_lines = [line for line in error_msg.split('\n') if line.strip()]
-                user_error = '\n'.join(error_lines[-5:]) if error_lines else error_msg
-            
+        if process.returncode != 0:
             raise HTTPException(
                 status_code=400,
-                detail=user_error
+                detail=ffmpeg_error_message(stderr)
             )
         
         # Проверяем, что выходной файл создан
-        if not output_path.exists() or output_path.stat().st_size == 0:
+        try:
+            output_size = (await run_blocking(os.stat, output_path)).st_size
+        except FileNotFoundError:
+            output_size = 0
+        
+        if output_size == 0:
             logger.error(f"Output file not created or empty: {output_path}")
             raise HTTPException(
                 status_code=500,
                 detail="Conversion failed: output file not created"
             )
         
-        output_size = output_path.stat().st_size
         logger.info(f"Conversion successful: {output_size} bytes, file: {output_filename}")
         
         # Удаляем временный файл
-        temp_input_path.unlink(missing_ok=True)
+        await run_blocking(remove_files, temp_input_path)
         
         # Возвращаем результат
         if download:
-            return FileResponse(
-                path=str(output_path),
-                media_type=f"audio/{target_format}",
+            return output_file_response(
+                path=output_path,
+                media_type=MEDIA_TYPES[target_format],
                 filename=output_filename
             )
         else:
@@ -178,13 +790,12 @@ async def convert_audio(
     except HTTPException:
         # Пробрасываем HTTP исключения дальше
         logger.warning(f"Conversion failed for {file.filename}: HTTP exception")
-        temp_input_path.unlink(missing_ok=True)
+        await run_blocking(remove_files, temp_input_path, output_path)
         raise
     
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         logger.error(f"Conversion timeout for {file.filename}")
-        temp_input_path.unlink(missing_ok=True)
-        output_path.unlink(missing_ok=True)
+        await run_blocking(remove_files, temp_input_path, output_path)
         raise HTTPException(
             status_code=500,
             detail="Conversion timeout: file is too large or processing took too long"
@@ -193,8 +804,7 @@ async def convert_audio(
     except Exception as e:
         # Очищаем временные файлы при ошибке
         logger.error(f"Unexpected error during conversion of {file.filename}: {str(e)}")
-        temp_input_path.unlink(missing_ok=True)
-        output_path.unlink(missing_ok=True)
+        await run_blocking(remove_files, temp_input_path, output_path)
         raise HTTPException(
             status_code=500,
             detail=f"Conversion error: {str(e)}"
@@ -212,28 +822,30 @@ async def download_file(filename: str):
     Returns:
         Файл для скачивания
     """
+    # Проверяем имя файла до обращения к ФС (безопасность): без разделителей
+    # пути и кроме "." и ".." файл может лежать только прямо в OUTPUT_DIR.
+    # Имена с ведущей точкой допустимы: convert_audio создаёт их из загрузок вроде ".voice.ogg"
+    if "/" in filename or "\\" in filename or "\0" in filename or filename in (".", ".."):
+        raise HTTPException(
+            status_code=403,
+            detail="Access denied"
+        )
+    
     file_path = OUTPUT_DIR / filename
     
     # Проверяем существование файла
-    if not file_path.exists():
+    if not file_path.is_file():
         raise HTTPException(
             status_code=404,
             detail=f"File not found: {filename}"
         )
     
-    # Проверяем, что файл находится в разрешённой директории (безопасность)
-    if not str(file_path.resolve()).startswith(str(OUTPUT_DIR.resolve())):
-        raise HTTPException(
-            status_code=403,
-            detail="Access denied"
-        )
-    
     # Определяем media type по расширению
     extension = file_path.suffix.lstrip('.')
-    media_type = f"audio/{extension}" if extension in SUPPORTED_FORMATS else "application/octet-stream"
+    media_type = MEDIA_TYPES.get(extension, DEFAULT_MEDIA_TYPE)
     
-    return FileResponse(
-        path=str(file_path),
+    return output_file_response(
+        path=file_path,
         media_type=media_type,
         filename=filename
     )
@@ -242,19 +854,11 @@ async def download_file(filename: str):
 @app.get("/health")
 async def health_check():
     """Health check эндпоинт для мониторинга"""
-    # Проверяем доступность ffmpeg
-    try:
-        result = subprocess.run(
-            ["ffmpeg", "-version"],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        ffmpeg_available = result.returncode == 0
-        ffmpeg_version = result.stdout.split('\n')[0] if ffmpeg_available else "Not available"
-    except Exception as e:
-        ffmpeg_available = False
-        ffmpeg_version = f"Error: {str(e)}"
+    # Проверяем доступность ffmpeg не чаще раза в FFMPEG_CHECK_TTL секунд
+    if _FFMPEG_CACHE["val"] is None or time.monotonic() - _FFMPEG_CACHE["ts"] >= FFMPEG_CHECK_TTL:
+        ffmpeg_available, ffmpeg_version = await probe_ffmpeg()
+    else:
+        ffmpeg_available, ffmpeg_version = _FFMPEG_CACHE["val"]
     
     return {
         "status": "healthy" if ffmpeg_available else "degraded",